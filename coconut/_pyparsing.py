@@ -21,10 +21,11 @@ from coconut.root import *  # NOQA
 
 import os
 import re
+import gc
+import heapq
 import sys
 import traceback
 from warnings import warn
-from collections import defaultdict
 from itertools import permutations
 from functools import wraps
 from pprint import pprint
@@ -51,6 +52,7 @@ from coconut.constants import (
     use_cache_file,
 )
 from coconut.util import get_clock_time  # NOQA
+from coconut.util import get_clock_time_ns
 from coconut.util import (
     ver_str_to_tuple,
     ver_tuple_to_str,
@@ -163,29 +165,57 @@ else:
     def _parseCache(self, instring, loc, doActions=True, callPreParse=True):
         # [CPYPARSING] HIT, MISS are constants
         # [CPYPARSING] include packrat_context, merge callPreParse and doActions
+        # [CPYPARSING] don't take packrat_cache_lock, since dict get/set are already atomic
         lookup = (self, instring, loc, callPreParse | doActions << 1, ParserElement.packrat_context)
-        with ParserElement.packrat_cache_lock:
-            cache = ParserElement.packrat_cache
-            value = cache.get(lookup)
-            if value is cache.not_in_cache:
-                ParserElement.packrat_cache_stats[MISS] += 1
-                try:
-                    value = self._parseNoCache(instring, loc, doActions, callPreParse)
-                except ParseBaseException as pe:
-                    # cache a copy of the exception, without the traceback
-                    cache.set(lookup, pe.__class__(*pe.args))
-                    raise
-                else:
-                    cache.set(lookup, (value[0], value[1].copy()))
-                    return value
+        cache = ParserElement.packrat_cache
+        value = cache.get(lookup)
+        if value is cache.not_in_cache:
+            ParserElement.packrat_cache_stats[MISS] += 1
+            try:
+                value = self._parseNoCache(instring, loc, doActions, callPreParse)
+            except ParseBaseException as pe:
+                # cache a copy of the exception, without the traceback
+                cache.set(lookup, pe.__class__(*pe.args))
+                raise
             else:
-                ParserElement.packrat_cache_stats[HIT] += 1
-                if isinstance(value, Exception):
-                    raise value
-                return value[0], value[1].copy()
+                # results must be copied in and out since callers mutate them in place (e.g. And does resultlist += exprtokens)
+                cache.set(lookup, (value[0], value[1].copy()))
+                return value
+        else:
+            ParserElement.packrat_cache_stats[HIT] += 1
+            if isinstance(value, Exception):
+                raise value
+            return value[0], value[1].copy()
 
     ParserElement._parseCache = _parseCache
 
+    # [CPYPARSING] use a C-level unbounded cache and expose it as .cache
+    class _UnboundedCache(object):
+        """Unbounded packrat cache that directly exposes the C-level methods of the underlying dict."""
+        # values are always tuples or exceptions, so cache.get returning None is unambiguous
+        not_in_cache = None
+
+        def __init__(self):
+            self.cache = {}
+            self.get = self.cache.get
+            self.set = self.cache.__setitem__
+            self.clear = self.cache.clear
+
+        def __len__(self):
+            return len(self.cache)
+
+    def enablePackrat(cache_size_limit=128):
+        """Version of ParserElement.enablePackrat that uses _UnboundedCache."""
+        if not ParserElement._packratEnabled:
+            ParserElement._packratEnabled = True
+            if cache_size_limit is None:
+                ParserElement.packrat_cache = _UnboundedCache()
+            else:
+                ParserElement.packrat_cache = ParserElement._FifoCache(cache_size_limit)
+            ParserElement._parse = ParserElement._parseCache
+
+    ParserElement.enablePackrat = staticmethod(enablePackrat)
+
     # [CPYPARSING] fix append
     def append(self, other):
         if (self.parseAction
@@ -288,6 +318,11 @@ if SUPPORTS_INCREMENTAL:
 else:
     all_parse_elements = None
 
+pyparsing_element_classes = tuple(
+    obj for obj in vars(_pyparsing).values()
+    if isinstance(obj, type) and issubclass(obj, ParserElement)
+)
+
 
 # -----------------------------------------------------------------------------------------------------------------------
 # MISSING OBJECTS:
@@ -295,13 +330,36 @@ else:
 
 python_quoted_string = getattr(_pyparsing, "python_quoted_string", None)
 if python_quoted_string is None:
-    python_quoted_string = _pyparsing.Combine(
+
+    class PythonQuotedString(_pyparsing.Token):
+        """Matches a Python string literal using only the regexes for its opening quote."""
         # multiline strings must come first
-        (_pyparsing.Regex(r'"""(?:[^"\\]|""(?!")|"(?!"")|\\.)*', flags=re.MULTILINE) + '"""').setName("multiline double quoted string")
-        | (_pyparsing.Regex(r"'''(?:[^'\\]|''(?!')|'(?!'')|\\.)*", flags=re.MULTILINE) + "'''").setName("multiline single quoted string")
-        | (_pyparsing.Regex(r'"(?:[^"\n\r\\]|(?:\\")|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*') + '"').setName("double quoted string")
-        | (_pyparsing.Regex(r"'(?:[^'\n\r\\]|(?:\\')|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*") + "'").setName("single quoted string")
-    ).setName("Python quoted string")
+        quote_regexes = {
+            '"': (
+                re.compile(r'"""(?:[^"\\]|""(?!")|"(?!"")|\\.)*"""'),
+                re.compile(r'"(?:[^"\n\r\\]|(?:\\")|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*"'),
+            ),
+            "'": (
+                re.compile(r"'''(?:[^'\\]|''(?!')|'(?!'')|\\.)*'''"),
+                re.compile(r"'(?:[^'\n\r\\]|(?:\\')|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*'"),
+            ),
+        }
+
+        def __init__(self):
+            super(PythonQuotedString, self).__init__()
+            self.mayReturnEmpty = False
+            self.mayIndexError = False
+
+        def parseImpl(self, instring, loc, doActions=True):
+            regexes = self.quote_regexes.get(instring[loc:loc + 1])
+            if regexes is not None:
+                multiline_regex, single_line_regex = regexes
+                match = multiline_regex.match(instring, loc) or single_line_regex.match(instring, loc)
+                if match:
+                    return match.end(), match.group()
+            raise _pyparsing.ParseException(instring, loc, self.errmsg, self)
+
+    python_quoted_string = PythonQuotedString().setName("Python quoted string")
     _pyparsing.python_quoted_string = python_quoted_string
 
 
@@ -326,21 +384,25 @@ _old_pyparsing_reprs = []
 
 def set_fast_pyparsing_reprs():
     """Make pyparsing much faster by preventing it from computing expensive nested string representations."""
-    for obj in vars(_pyparsing).values():
-        try:
-            if issubclass(obj, ParserElement):
-                _old_pyparsing_reprs.append((obj, (obj.__repr__, obj.__str__)))
-                obj.__repr__ = fast_repr
-                obj.__str__ = fast_repr
-        except TypeError:
-            pass
+    for obj in pyparsing_element_classes:
+        # only save the methods defined on obj itself, since its bases might already have fast reprs
+        _old_pyparsing_reprs.append((obj, (vars(obj).get("__repr__"), vars(obj).get("__str__"))))
+        obj.__repr__ = fast_repr
+        obj.__str__ = fast_repr
 
 
 def unset_fast_pyparsing_reprs():
     """Restore pyparsing's default string representations for ease of debugging."""
-    for obj, (repr_method, str_method) in _old_pyparsing_reprs:
-        obj.__repr__ = repr_method
-        obj.__str__ = str_method
+    # restore in reverse order in case the same class was patched more than once
+    for obj, (repr_method, str_method) in reversed(_old_pyparsing_reprs):
+        if repr_method is None:
+            del obj.__repr__
+        else:
+            obj.__repr__ = repr_method
+        if str_method is None:
+            del obj.__str__
+        else:
+            obj.__str__ = str_method
     _old_pyparsing_reprs[:] = []
 
 
@@ -352,23 +414,64 @@ if use_fast_pyparsing_reprs:
 # PROFILING:
 # -----------------------------------------------------------------------------------------------------------------------
 
-_timing_info = [None]  # in list to allow reassignment
-
-
-class _timing_sentinel(object):
-    __slots__ = ()
+untimed_attr_names = frozenset((
+    "__getattribute__",
+    "__setattribute__",
+    "__init_subclass__",
+    "__subclasshook__",
+    "__class__",
+    "__setattr__",
+    "__getattr__",
+    "__new__",
+    "__init__",
+    "__str__",
+    "__repr__",
+    "__hash__",
+    "__eq__",
+    "_trim_traceback",
+    "_ErrorStop",
+    "_UnboundedCache",
+    "enablePackrat",
+    "enableIncremental",
+    "inlineLiteralsUsing",
+    "setDefaultWhitespaceChars",
+    "setDefaultKeywordChars",
+    "resetCache",
+))
+
+
+def get_static_attr(cls, attr_name, default=None):
+    """Get attr_name from cls's MRO without invoking the descriptor protocol."""
+    for base in cls.__mro__:
+        if attr_name in vars(base):
+            return vars(base)[attr_name]
+    return default
 
 
 def add_timing_to_method(cls, method_name, method):
-    """Add timing collection to the given method.
-    It's a monstrosity, but it's only used for profiling."""
+    """Add timing collection to the given method."""
+    if isinstance(get_static_attr(cls, method_name), (classmethod, staticmethod)):
+        return False
+
     @wraps(method)
     def new_method(self, *args, **kwargs):
-        start_time = get_clock_time()
+        start_time = get_clock_time_ns()
         try:
             return method(self, *args, **kwargs)
         finally:
-            _timing_info[0][ascii(self)] += get_clock_time() - start_time
+            self._timing_total += get_clock_time_ns() - start_time
+
+    if method_name == "copy":
+        timed_copy = new_method
+
+        @wraps(method)
+        def new_method(self, *args, **kwargs):
+            new_elem = timed_copy(self, *args, **kwargs)
+            # copies shouldn't inherit the original's timing info
+            if new_elem is not self:
+                vars(new_elem).pop("_timing_total", None)
+            return new_elem
+
     new_method._timed = True
     setattr(cls, method_name, new_method)
     return True
@@ -379,49 +482,34 @@ def collect_timing_info():
     It's a monstrosity, but it's only used for profiling."""
     from coconut.terminal import logger  # hide to avoid circular imports
     logger.log("adding timing to pyparsing elements:")
-    _timing_info[0] = defaultdict(float)
-    for obj in vars(_pyparsing).values():
-        if isinstance(obj, type) and issubclass(obj, ParserElement):
-            added_timing = False
-            for attr_name in dir(obj):
-                attr = getattr(obj, attr_name)
-                if (
-                    callable(attr)
-                    and not isinstance(attr, ParserElement)
-                    and not getattr(attr, "_timed", False)
-                    and attr_name not in (
-                        "__getattribute__",
-                        "__setattribute__",
-                        "__init_subclass__",
-                        "__subclasshook__",
-                        "__class__",
-                        "__setattr__",
-                        "__getattr__",
-                        "__new__",
-                        "__init__",
-                        "__str__",
-                        "__repr__",
-                        "__hash__",
-                        "__eq__",
-                        "_trim_traceback",
-                        "_ErrorStop",
-                        "_UnboundedCache",
-                        "enablePackrat",
-                        "enableIncremental",
-                        "inlineLiteralsUsing",
-                        "setDefaultWhitespaceChars",
-                        "setDefaultKeywordChars",
-                        "resetCache",
-                    )
-                ):
-                    added_timing |= add_timing_to_method(obj, attr_name, attr)
-            if added_timing:
-                logger.log("\tadded timing to", obj)
-    return _timing_info
+    ParserElement._timing_total = 0
+    for obj in pyparsing_element_classes:
+        added_timing = False
+        for attr_name in dir(obj):
+            if attr_name in untimed_attr_names:
+                continue
+            attr = getattr(obj, attr_name)
+            if (
+                callable(attr)
+                and not isinstance(attr, ParserElement)
+                and not getattr(attr, "_timed", False)
+            ):
+                added_timing |= add_timing_to_method(obj, attr_name, attr)
+        if added_timing:
+            logger.log("\tadded timing to", obj)
+
+
+def get_timed_elems():
+    """Get all pyparsing elements that have timing info from collect_timing_info()."""
+    return [
+        elem for elem in gc.get_objects()
+        if isinstance(elem, ParserElement) and "_timing_total" in vars(elem)
+    ]
 
 
 def print_timing_info():
     """Print timing_info collected by collect_timing_info()."""
+    timed_elems = get_timed_elems()
     print(
         """
 =====================================
@@ -429,12 +517,12 @@ Timing info:
 (timed {num} total pyparsing objects)
 =====================================
         """.rstrip().format(
-            num=len(_timing_info[0]),
+            num=len(timed_elems),
         ),
     )
-    sorted_timing_info = sorted(_timing_info[0].items(), key=lambda kv: kv[1])[-num_displayed_timing_items:]
-    for method_name, total_time in sorted_timing_info:
-        print("{method_name}:\t{total_time}".format(method_name=method_name, total_time=total_time))
+    sorted_timed_elems = heapq.nlargest(num_displayed_timing_items, timed_elems, key=lambda elem: elem._timing_total)
+    for elem in reversed(sorted_timed_elems):
+        print("{method_name}:\t{total_time}".format(method_name=ascii(elem), total_time=elem._timing_total / 1e9))
 
 
 _profiled_MatchFirst_objs = {}
@@ -449,19 +537,25 @@ def add_profiling_to_MatchFirsts():
             _profiled_MatchFirst_objs[id(self)] = self
             self.expr_usage_stats = []
             self.expr_timing_stats = []
-        while len(self.expr_usage_stats) < len(self.exprs):
-            self.expr_usage_stats.append(0)
-            self.expr_timing_stats.append([])
+        exprs = self.exprs
+        expr_usage_stats = self.expr_usage_stats
+        expr_timing_stats = self.expr_timing_stats
+        while len(expr_usage_stats) < len(exprs):
+            expr_usage_stats.append(0)
+            expr_timing_stats.append([0, 0])  # [total_time_ns, num_calls]
         maxExcLoc = -1
         maxException = None
-        for i, e in enumerate(self.exprs):
+        for i in range(len(exprs)):
+            e = exprs[i]
+            timing_stats = expr_timing_stats[i]
             try:
-                start_time = get_clock_time()
+                start_time = get_clock_time_ns()
                 try:
                     ret = e._parse(instring, loc, doActions)
                 finally:
-                    self.expr_timing_stats[i].append(get_clock_time() - start_time)
-                self.expr_usage_stats[i] += 1
+                    timing_stats[0] += get_clock_time_ns() - start_time
+                    timing_stats[1] += 1
+                expr_usage_stats[i] += 1
                 return ret
             except _pyparsing.ParseException as err:
                 if err.loc > maxExcLoc:
@@ -471,12 +565,11 @@ def add_profiling_to_MatchFirsts():
                 if len(instring) > maxExcLoc:
                     maxException = _pyparsing.ParseException(instring, len(instring), e.errmsg, self)
                     maxExcLoc = len(instring)
+        if maxException is not None:
+            maxException.msg = self.errmsg
+            raise maxException
         else:
-            if maxException is not None:
-                maxException.msg = self.errmsg
-                raise maxException
-            else:
-                raise _pyparsing.ParseException(instring, loc, "no defined alternatives to match", self)
+            raise _pyparsing.ParseException(instring, loc, "no defined alternatives to match", self)
 
     _pyparsing.MatchFirst.parseImpl = new_parseImpl
     return _profiled_MatchFirst_objs
@@ -485,8 +578,10 @@ def add_profiling_to_MatchFirsts():
 def time_for_ordering(expr_usage_stats, expr_timing_aves):
     """Get the total time for a given MatchFirst ordering."""
     total_time = 0
-    for i, n in enumerate(expr_usage_stats):
-        total_time += n * sum(expr_timing_aves[:i + 1])
+    cum_timing_ave = 0
+    for n, timing_ave in zip(expr_usage_stats, expr_timing_aves):
+        cum_timing_ave += timing_ave
+        total_time += n * cum_timing_ave
     return total_time
 
 
@@ -494,9 +589,9 @@ def find_best_ordering(obj, num_perms_to_eval=None):
     """Get the best ordering of the MatchFirst."""
     if num_perms_to_eval is None:
         num_perms_to_eval = True if len(obj.exprs) <= 10 else 100000
-    best_ordering = None
+    best_perm = None
     best_time = float("inf")
-    stats_zip = tuple(zip(obj.expr_usage_stats, obj.expr_timing_aves, obj.exprs))
+    stats_zip = tuple(zip(obj.expr_usage_stats, obj.expr_timing_aves, range(len(obj.exprs))))
     if num_perms_to_eval is True:
         perms_to_eval = permutations(stats_zip)
     else:
@@ -506,8 +601,9 @@ def find_best_ordering(obj, num_perms_to_eval=None):
             sorted(stats_zip, key=lambda u_t_e: (u_t_e[1], -u_t_e[0])),
         ]
         if num_perms_to_eval:
-            max_usage = max(obj.expr_usage_stats)
-            max_time = max(obj.expr_timing_aves)
+            # avoid dividing by zero when no alternative ever matched
+            max_usage = max(obj.expr_usage_stats) or 1
+            max_time = max(obj.expr_timing_aves) or 1
             for i in range(1, num_perms_to_eval):
                 a = i / num_perms_to_eval
                 perms_to_eval.append(sorted(
@@ -517,11 +613,15 @@ def find_best_ordering(obj, num_perms_to_eval=None):
                         + (1 - a) * u_t_e[1] / max_time,
                 ))
     for perm in perms_to_eval:
-        perm_expr_usage_stats, perm_expr_timing_aves = zip(*[(usage, timing) for usage, timing, expr in perm])
+        perm_expr_usage_stats, perm_expr_timing_aves = zip(*[(usage, timing) for usage, timing, ind in perm])
         perm_time = time_for_ordering(perm_expr_usage_stats, perm_expr_timing_aves)
         if perm_time < best_time:
             best_time = perm_time
-            best_ordering = [(obj.exprs.index(expr), parse_expr_repr(expr)) for usage, timing, expr in perm]
+            best_perm = perm
+    if best_perm is None:
+        best_ordering = None
+    else:
+        best_ordering = [(ind, parse_expr_repr(obj.exprs[ind])) for usage, timing, ind in best_perm]
     return best_ordering, best_time
 
 
@@ -539,10 +639,10 @@ def parse_expr_repr(obj):
 def print_poorly_ordered_MatchFirsts():
     """Print poorly ordered MatchFirsts."""
     for obj in _profiled_MatchFirst_objs.values():
-        obj.expr_timing_aves = [sum(ts) / len(ts) if ts else 0 for ts in obj.expr_timing_stats]
+        obj.expr_timing_aves = [total_time / num_calls / 1e9 if num_calls else 0 for total_time, num_calls in obj.expr_timing_stats]
         obj.naive_timing_improvement = naive_timing_improvement(obj)
-    most_improveable = sorted(_profiled_MatchFirst_objs.values(), key=lambda obj: obj.naive_timing_improvement)[-num_displayed_timing_items:]
-    for obj in most_improveable:
+    most_improveable = heapq.nlargest(num_displayed_timing_items, _profiled_MatchFirst_objs.values(), key=lambda obj: obj.naive_timing_improvement)
+    for obj in reversed(most_improveable):
         print("\n" + parse_expr_repr(obj) + " (" + str(obj.naive_timing_improvement) + "):")
         pprint(list(zip(map(parse_expr_repr, obj.exprs), obj.expr_usage_stats, obj.expr_timing_aves)))
         best_ordering, best_time = find_best_ordering(obj)
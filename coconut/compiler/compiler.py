@@ -555,16 +555,13 @@ class Compiler(Grammar, pickleable_obj):
                 "package_level": package_level,
             },
         )
-        return hex(
-            checksum(
-                hash_sep.join(
-                    str(item) for item in (
-                        reduce_args
-                        + (VERSION, package_level, code)
-                    )
-                ).encode(default_encoding),
-            ),
-        )
+        # fold each item into the checksum separately to avoid joining a copy of code
+        hash_val = 0
+        for i, item in enumerate(reduce_args + (VERSION, package_level, code)):
+            if i:
+                hash_val = checksum(hash_sep.encode(default_encoding), hash_val)
+            hash_val = checksum(str(item).encode(default_encoding), hash_val)
+        return hex(hash_val)
 
     temp_var_counts = None
     operators = None
@@ -1209,12 +1206,12 @@ class Compiler(Grammar, pickleable_obj):
         if include_causes:
             self.internal_assert(extra is None, original, loc, "make_err cannot include causes with extra")
             causes = dictset()
-            for cause, _, _ in all_matches(self.parse_err_msg, snippet[loc_in_snip:]):
-                if cause:
-                    causes.add(cause)
-            for cause, _, _ in all_matches(self.parse_err_msg, snippet[endpt_in_snip:]):
-                if cause:
-                    causes.add(cause)
+            for start in (loc_in_snip, endpt_in_snip):
+                causes.update(
+                    cause
+                    for cause, _, _ in all_matches(self.parse_err_msg, snippet[start:])
+                    if cause
+                )
             if causes:
                 extra = "possible cause{s}: {causes}".format(
                     s="s" if len(causes) > 1 else "",
@@ -735,8 +735,8 @@ def get_pyparsing_cache():
     packrat_cache = ParserElement.packrat_cache
     if isinstance(packrat_cache, dict):  # if enablePackrat is never called
         return packrat_cache
-    elif CPYPARSING:
-        return packrat_cache.cache  # cPyparsing adds this
+    elif hasattr(packrat_cache, "cache"):
+        return packrat_cache.cache  # cPyparsing and our pyparsing override add this
     else:  # on pyparsing we have to do this
         try:
             # this is sketchy, so errors should only be complained
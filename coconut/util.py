@@ -25,12 +25,12 @@ import shutil
 import json
 import traceback
 import time
-from zlib import crc32
 from warnings import warn
 from types import MethodType
 from contextlib import contextmanager
 from collections import defaultdict
 from functools import partial
+from itertools import repeat
 
 if sys.version_info >= (3, 2):
     from functools import lru_cache
@@ -40,6 +40,15 @@ else:
     except ImportError:
         lru_cache = None
 
+# prefer implementations of the same IEEE CRC-32 that use hardware carry-less multiplication
+try:
+    from isal.isal_zlib import crc32
+except ImportError:
+    try:
+        from zlib_ng.zlib_ng import crc32
+    except ImportError:
+        from zlib import crc32
+
 from coconut.root import _get_target_info
 from coconut.constants import (
     fixpath,
@@ -67,18 +76,26 @@ def univ_open(filename, opentype="r+", encoding=None, **kwargs):
     return open(filename, opentype, **kwargs)
 
 
-def checksum(data):
+def checksum(data, prev=0):
     """Compute a checksum of the given data.
+    Pass a previous checksum as prev to continue it over more data.
     Used for computing __coconut_hash__."""
-    return crc32(data) & 0xffffffff  # necessary for cross-compatibility
+    return crc32(data, prev) & 0xffffffff  # necessary for cross-compatibility
 
 
-def get_clock_time():
-    """Get a time to use for performance metrics."""
-    if PY2:
-        return time.clock()
-    else:
-        return time.process_time()
+# get a time to use for performance metrics
+if PY2:
+    get_clock_time = time.clock
+else:
+    get_clock_time = time.process_time
+
+
+if PY2 or not hasattr(time, "process_time_ns"):
+    def get_clock_time_ns():
+        """Get an integer time in nanoseconds to use for performance metrics."""
+        return int(get_clock_time() * 1e9)
+else:
+    get_clock_time_ns = time.process_time_ns
 
 
 first_import_time = get_clock_time()
@@ -108,7 +125,7 @@ class const(pickleable_obj):
 
 class override(pickleable_obj):
     """Implementation of Coconut's @override for use within Coconut."""
-    __slots__ = ("func",)
+    __slots__ = ("func", "func_get")
 
     def __eq__(self, other):
         return self.__class__ is other.__class__ and self.__reduce__() == other.__reduce__()
@@ -119,13 +136,14 @@ class override(pickleable_obj):
     # from override
     def __init__(self, func):
         self.func = func
+        self.func_get = getattr(func, "__get__", None)
 
     def __get__(self, obj, objtype=None):
-        if hasattr(self.func, "__get__"):
+        if self.func_get is not None:
             if objtype is None:
-                return self.func.__get__(obj)
+                return self.func_get(obj)
             else:
-                return self.func.__get__(obj, objtype)
+                return self.func_get(obj, objtype)
         if obj is None:
             return self.func
         if PY2:
@@ -150,8 +168,16 @@ def clip(num, min=None, max=None):
     )
 
 
+# characters that str.splitlines splits on but that don't end logical lines
+non_logical_line_breaks = ("\v", "\f", "\x1c", "\x1d", "\x1e", "\x85", "\u2028", "\u2029")
+
+
 def logical_lines(text, keep_newlines=False):
     """Iterate over the logical code lines in text."""
+    if not any(char in text for char in non_logical_line_breaks):
+        for line in text.splitlines(keep_newlines):
+            yield line
+        return
     prev_content = None
     for line in text.splitlines(True):
         real_line = True
@@ -177,9 +203,7 @@ def logical_lines(text, keep_newlines=False):
 
 def normalize_newlines(text):
     """Normalize all newlines in text to \\n."""
-    norm_text = text.replace(non_syntactic_newline, "\n").replace("\r", "\n")
-    assert len(norm_text) == len(text), "failed to normalize newlines"
-    return norm_text
+    return text.replace(non_syntactic_newline, "\n").replace("\r", "\n")
 
 
 def get_encoding(fileobj):
@@ -232,23 +256,28 @@ def memoize(maxsize=None, *args, **kwargs):
         return lru_cache(maxsize, *args, **kwargs)
 
 
+class memoized_exception(object):
+    """Wrapper marking an exception memoized by memoize_with_exceptions."""
+    __slots__ = ("exc",)
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
 def memoize_with_exceptions(*memo_args, **memo_kwargs):
     """Decorator that works like memoize but also memoizes exceptions."""
     def memoizer(func):
         @memoize(*memo_args, **memo_kwargs)
         def memoized_safe_func(*args, **kwargs):
-            res = exc = None
             try:
-                res = func(*args, **kwargs)
+                return func(*args, **kwargs)
             except Exception as exc:
-                return res, exc
-            else:
-                return res, exc
+                return memoized_exception(exc)
 
         def memoized_func(*args, **kwargs):
-            res, exc = memoized_safe_func(*args, **kwargs)
-            if exc is not None:
-                raise exc
+            res = memoized_safe_func(*args, **kwargs)
+            if res.__class__ is memoized_exception:
+                raise res.exc
             return res
         return memoized_func
     return memoizer
@@ -258,8 +287,8 @@ class keydefaultdict(defaultdict, object):
     """Version of defaultdict that calls the factory with the key."""
 
     def __missing__(self, key):
-        self[key] = self.default_factory(key)
-        return self[key]
+        val = self[key] = self.default_factory(key)
+        return val
 
 
 class dictset(dict, object):
@@ -271,6 +300,9 @@ class dictset(dict, object):
     def add(self, item):
         self[item] = True
 
+    def update(self, items):
+        dict.update(self, zip(items, repeat(True)))
+
 
 def assert_remove_prefix(inputstr, prefix, allow_no_prefix=False):
     """Remove prefix asserting that inputstr starts with it."""
@@ -298,14 +330,16 @@ def ensure_dir(dirpath, logger=None):
 
 def without_keys(inputdict, rem_keys):
     """Get a copy of inputdict without rem_keys."""
-    return {k: v for k, v in inputdict.items() if k not in rem_keys}
+    outdict = dict(inputdict)
+    for k in rem_keys:
+        outdict.pop(k, None)
+    return outdict
 
 
 def split_leading_whitespace(inputstr):
     """Split leading whitespace."""
     basestr = inputstr.lstrip()
     whitespace = inputstr[:len(inputstr) - len(basestr)]
-    assert whitespace + basestr == inputstr, "invalid whitespace split: " + repr(inputstr)
     return whitespace, basestr
 
 
@@ -313,7 +347,6 @@ def split_trailing_whitespace(inputstr):
     """Split trailing whitespace."""
     basestr = inputstr.rstrip()
     whitespace = inputstr[len(basestr):]
-    assert basestr + whitespace == inputstr, "invalid whitespace split: " + repr(inputstr)
     return basestr, whitespace
 
 
@@ -332,21 +365,16 @@ def replace_all(inputstr, all_to_replace, replace_to):
 get_target_info = _get_target_info
 
 
+@memoize(128)
 def ver_tuple_to_str(req_ver):
     """Converts a requirement version tuple into a version string."""
     return ".".join(str(x) for x in req_ver)
 
 
+@memoize(256)
 def ver_str_to_tuple(ver_str):
     """Convert a version string into a version tuple."""
-    out = []
-    for x in ver_str.split("."):
-        try:
-            x = int(x)
-        except ValueError:
-            pass
-        out.append(x)
-    return tuple(out)
+    return tuple(int(x) if x.isdigit() else x for x in ver_str.split("."))
 
 
 def get_next_version(req_ver, point_to_increment=-1):
@@ -354,6 +382,7 @@ def get_next_version(req_ver, point_to_increment=-1):
     return req_ver[:point_to_increment] + (req_ver[point_to_increment] + 1,)
 
 
+@memoize(128)
 def get_displayable_target(target):
     """Get a displayable version of the target."""
     try:
@@ -375,6 +404,7 @@ def get_kernel_data_files(argv):
         executable = sys.executable
     else:
         return []
+    make_custom_kernel(executable)
     install_custom_kernel(executable)
     return [
         (
@@ -386,12 +416,10 @@ def get_kernel_data_files(argv):
 
 def install_custom_kernel(executable=None, logger=None):
     """Force install the custom kernel."""
-    kernel_source = os.path.join(icoconut_custom_kernel_dir, "kernel.json")
     kernel_dest = fixpath(os.path.join(sys.exec_prefix, icoconut_custom_kernel_install_loc))
     try:
-        make_custom_kernel(executable)
         ensure_dir(kernel_dest)
-        shutil.copy(kernel_source, kernel_dest)
+        make_custom_kernel(executable, kernel_dest)
     except OSError:
         existing_kernel = os.path.join(kernel_dest, "kernel.json")
         if os.path.exists(existing_kernel):
@@ -418,8 +446,9 @@ def install_custom_kernel(executable=None, logger=None):
         return kernel_dest
 
 
-def make_custom_kernel(executable=None):
-    """Write custom kernel file and return its directory."""
+def make_custom_kernel(executable=None, kernel_dir=None):
+    """Write custom kernel file into kernel_dir (defaults to the package's
+    kernel directory, which is recreated) and return kernel_dir."""
     if executable is None:
         executable = sys.executable
     kernel_dict = {
@@ -427,10 +456,12 @@ def make_custom_kernel(executable=None):
         "display_name": "Coconut",
         "language": "coconut",
     }
-    if os.path.exists(icoconut_custom_kernel_dir):
-        shutil.rmtree(icoconut_custom_kernel_dir)
-    os.mkdir(icoconut_custom_kernel_dir)
-    with univ_open(os.path.join(icoconut_custom_kernel_dir, "kernel.json"), "wb") as kernel_file:
+    if kernel_dir is None:
+        kernel_dir = icoconut_custom_kernel_dir
+        if os.path.exists(kernel_dir):
+            shutil.rmtree(kernel_dir)
+        os.mkdir(kernel_dir)
+    with univ_open(os.path.join(kernel_dir, "kernel.json"), "wb") as kernel_file:
         raw_json = json.dumps(kernel_dict, indent=1)
         kernel_file.write(raw_json.encode(encoding=default_encoding))
-    return icoconut_custom_kernel_dir
+    return kernel_dir